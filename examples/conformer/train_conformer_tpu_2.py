@@ -19,6 +19,7 @@ from tensorflow_asr.utils import setup_environment, setup_tpu
 
 setup_environment()
 import tensorflow as tf
+import tensorflow_addons as tfa
 
 DEFAULT_YAML = os.path.join(os.path.abspath(os.path.dirname(__file__)), "config.yml")
 
@@ -28,19 +29,46 @@ parser = argparse.ArgumentParser(prog="Conformer Training")
 
 parser.add_argument("--config", type=str, default=DEFAULT_YAML, help="The file path of model configuration file")
 
+parser.add_argument("--tfrecords", default=False, action="store_true",
+                    help="Whether to use tfrecords, default to tfrecords only if train shards already exist")
+
 parser.add_argument("--sentence_piece", default=False, action="store_true", help="Whether to use `SentencePiece` model")
 
 parser.add_argument("--bs", type=int, default=None, help="Batch size per replica")
 
 parser.add_argument("--spx", type=int, default=50, help="Steps per execution for maximizing TPU performance")
 
+parser.add_argument("--unroll", type=int, default=1, help="Number of steps unrolled in each steps per execution loop")
+
 parser.add_argument("--tpu_address", type=str, default=None, help="TPU address. Leave None on Colab")
 
+parser.add_argument("--data_service_address", type=str, default=None,
+                    help="tf.data service dispatcher (grpc://host:port) to run preprocessing on, requires use_tf tfrecords "
+                         "datasets: the slice datasets' numpy_function wav fallback cannot be served, even with use_tf")
+
 parser.add_argument("--metadata_prefix", type=str, default=None, help="Path to file containing metadata")
 
-parser.add_argument("--compute_lengths", default=False, action="store_true", help="Whether to compute lengths")
+parser.add_argument("--compute_lengths", default=False, action="store_true",
+                    help="Deprecated: compute metadata with scripts/create_tfrecords.py --metadata_prefix instead")
+
+parser.add_argument("--use_cached_features", default=False, action="store_true",
+                    help="Whether tfrecords store extracted features (created with --cache_features)")
+
+parser.add_argument("--snapshot", default=False, action="store_true",
+                    help="Store extracted tfrecords features in tfrecords_dir on the first epoch "
+                         "and read them back afterwards")
+
+parser.add_argument("--raw_audio", default=False, action="store_true",
+                    help="Feed raw signals and extract features inside the model on TPU, requires use_tf datasets")
 
-parser.add_argument("--mxp", default=False, action="store_true", help="Enable mixed precision")
+parser.add_argument("--bucket_boundaries", type=int, nargs="*", default=None, help="Input lengths to bucket utterances by")
+
+parser.add_argument("--lamb", default=False, action="store_true",
+                    help="Use LAMB optimizer instead of Adam for large batch training")
+
+parser.add_argument("--mxp", default=False, action="store_true", help="Enable mixed precision (bfloat16 on TPU)")
+
+parser.add_argument("--bf16_allreduce", default=False, action="store_true", help="All-reduce gradients in bfloat16")
 
 parser.add_argument("--subwords", type=str, default=None, help="Path to file that stores generated subwords")
 
@@ -50,41 +78,79 @@ parser.add_argument("--saved", type=str, default=None, help="Path to saved model
 
 args = parser.parse_args()
 
-tf.config.optimizer.set_experimental_options({"auto_mixed_precision": args.mxp})
-
 strategy = setup_tpu(args.tpu_address)
 
+if args.mxp:
+    tf.keras.mixed_precision.set_global_policy("mixed_bfloat16")
+
 from tensorflow_asr.configs.config import Config
-from tensorflow_asr.datasets.keras import ASRTFRecordDatasetKeras
+from tensorflow_asr.datasets.keras import ASRTFRecordDatasetKeras, ASRSliceDatasetKeras
 from tensorflow_asr.featurizers.speech_featurizers import TFSpeechFeaturizer
 from tensorflow_asr.featurizers.text_featurizers import SubwordFeaturizer, SentencePieceFeaturizer, CharFeaturizer
 from tensorflow_asr.models.keras.conformer import Conformer
 from tensorflow_asr.optimizers.schedules import TransformerSchedule
+from tensorflow_asr.callbacks.checkpoint import AsyncModelCheckpoint
 
 config = Config(args.config)
 speech_featurizer = TFSpeechFeaturizer(config.speech_config)
 
 text_featurizer = CharFeaturizer(config.decoder_config)
 
-train_dataset = ASRTFRecordDatasetKeras(
-    speech_featurizer=speech_featurizer, text_featurizer=text_featurizer,
-    **vars(config.learning_config.train_dataset_config),
-    indefinite=True
-)
-eval_dataset = ASRTFRecordDatasetKeras(
-    speech_featurizer=speech_featurizer, text_featurizer=text_featurizer,
-    **vars(config.learning_config.eval_dataset_config),
-    indefinite=True
+if args.bucket_boundaries:
+    config.learning_config.train_dataset_config.bucket_boundaries = args.bucket_boundaries
+    config.learning_config.eval_dataset_config.bucket_boundaries = args.bucket_boundaries
+
+# TPU needs a static batch dimension, otherwise XLA recompiles for the last partial batch
+config.learning_config.train_dataset_config.drop_remainder = True
+config.learning_config.eval_dataset_config.drop_remainder = True
+
+train_tfrecords_dir = config.learning_config.train_dataset_config.tfrecords_dir
+train_stage = config.learning_config.train_dataset_config.stage
+use_tfrecords = args.tfrecords or (
+    train_tfrecords_dir is not None
+    and len(tf.io.gfile.glob(os.path.join(train_tfrecords_dir, f"{train_stage}*.tfrecord"))) > 0
 )
 
+if use_tfrecords:
+    train_dataset = ASRTFRecordDatasetKeras(
+        speech_featurizer=speech_featurizer, text_featurizer=text_featurizer,
+        **vars(config.learning_config.train_dataset_config),
+        indefinite=True, cache_features=args.use_cached_features, raw_audio=args.raw_audio, snapshot=args.snapshot
+    )
+    eval_dataset = ASRTFRecordDatasetKeras(
+        speech_featurizer=speech_featurizer, text_featurizer=text_featurizer,
+        **vars(config.learning_config.eval_dataset_config),
+        indefinite=True, cache_features=args.use_cached_features, raw_audio=args.raw_audio, snapshot=args.snapshot
+    )
+else:
+    if args.use_cached_features or args.snapshot:
+        raise ValueError("--use_cached_features and --snapshot require tfrecords, but none were found, "
+                         "create them with scripts/create_tfrecords.py or pass --tfrecords")
+    print("No tfrecords found, reading audio files directly, which is much slower ...")
+    train_dataset = ASRSliceDatasetKeras(
+        speech_featurizer=speech_featurizer, text_featurizer=text_featurizer,
+        **vars(config.learning_config.train_dataset_config),
+        indefinite=True, raw_audio=args.raw_audio
+    )
+    eval_dataset = ASRSliceDatasetKeras(
+        speech_featurizer=speech_featurizer, text_featurizer=text_featurizer,
+        **vars(config.learning_config.eval_dataset_config),
+        indefinite=True, raw_audio=args.raw_audio
+    )
+
 if args.compute_lengths:
-    train_dataset.update_lengths(args.metadata_prefix)
-    eval_dataset.update_lengths(args.metadata_prefix)
+    print("Warning: --compute_lengths is deprecated, use scripts/create_tfrecords.py --metadata_prefix instead")
+    train_dataset.update_metadata(args.metadata_prefix)
+    eval_dataset.update_metadata(args.metadata_prefix)
 
 # Update metadata calculated from both train and eval datasets
 train_dataset.load_metadata(args.metadata_prefix)
 eval_dataset.load_metadata(args.metadata_prefix)
 
+if speech_featurizer.max_length == 0:
+    print("Warning: max input length is unknown, batches are not padded to static shapes and XLA will recompile "
+          "for every new shape. Provide --metadata_prefix to pad to the max length or to the bucket boundaries")
+
 batch_size = args.bs if args.bs is not None else config.learning_config.running_config.batch_size
 global_batch_size = batch_size
 global_batch_size *= strategy.num_replicas_in_sync
@@ -92,35 +158,60 @@ global_batch_size *= strategy.num_replicas_in_sync
 train_data_loader = train_dataset.create(global_batch_size)
 eval_data_loader = eval_dataset.create(global_batch_size)
 
+if args.data_service_address:
+    if not use_tfrecords: raise ValueError("--data_service_address requires tfrecords datasets")
+    # Offload reading and featurizing to tf.data service workers (see scripts/run_data_service.py)
+    train_data_loader = train_data_loader.apply(
+        tf.data.experimental.service.distribute(processing_mode="parallel_epochs", service=args.data_service_address)
+    )
+
 with strategy.scope():
     # build model
     conformer = Conformer(**config.model_config, vocabulary_size=text_featurizer.num_classes)
-    conformer._build(speech_featurizer.shape, prediction_shape=text_featurizer.prepand_shape, batch_size=global_batch_size)
+    if args.raw_audio:
+        conformer.add_feature_extraction(config.speech_config)
+        input_shape = speech_featurizer.signal_shape
+    else:
+        input_shape = speech_featurizer.shape
+    conformer._build(input_shape, prediction_shape=text_featurizer.prepand_shape, batch_size=global_batch_size)
     conformer.summary(line_length=120)
 
     if args.saved:
         conformer.load_weights(args.saved, by_name=True, skip_mismatch=True)
 
-    optimizer = tf.keras.optimizers.Adam(
-        TransformerSchedule(
-            d_model=conformer.dmodel,
-            warmup_steps=config.learning_config.optimizer_config["warmup_steps"],
-            max_lr=(0.05 / math.sqrt(conformer.dmodel))
-        ),
-        beta_1=config.learning_config.optimizer_config["beta1"],
-        beta_2=config.learning_config.optimizer_config["beta2"],
-        epsilon=config.learning_config.optimizer_config["epsilon"]
+    optimizer_config = config.learning_config.optimizer_config
+    learning_rate = TransformerSchedule(
+        d_model=conformer.dmodel,
+        warmup_steps=optimizer_config["warmup_steps"],
+        max_lr=(0.05 / math.sqrt(conformer.dmodel))
     )
+    if args.lamb:
+        optimizer = tfa.optimizers.LAMB(
+            learning_rate,
+            beta_1=optimizer_config["beta1"],
+            beta_2=optimizer_config["beta2"],
+            epsilon=optimizer_config["epsilon"],
+            weight_decay_rate=optimizer_config.get("weight_decay_rate", 1e-4)
+        )
+    else:
+        optimizer = tf.keras.optimizers.Adam(
+            learning_rate,
+            beta_1=optimizer_config["beta1"],
+            beta_2=optimizer_config["beta2"],
+            epsilon=optimizer_config["epsilon"]
+        )
 
     conformer.compile(
         optimizer=optimizer,
         experimental_steps_per_execution=args.spx,
+        unrolled_steps_per_execution=args.unroll,
+        allreduce_dtype=(tf.bfloat16 if args.bf16_allreduce else None),
         global_batch_size=global_batch_size,
         blank=text_featurizer.blank
     )
 
 callbacks = [
-    tf.keras.callbacks.ModelCheckpoint(**config.learning_config.running_config.checkpoint),
+    AsyncModelCheckpoint(**config.learning_config.running_config.checkpoint),
     tf.keras.callbacks.experimental.BackupAndRestore(config.learning_config.running_config.states_dir),
     tf.keras.callbacks.TensorBoard(**config.learning_config.running_config.tensorboard)
 ]
@@ -19,6 +19,7 @@ from tensorflow_asr.utils import setup_environment, setup_strategy
 
 setup_environment()
 import tensorflow as tf
+import tensorflow_addons as tfa
 
 DEFAULT_YAML = os.path.join(os.path.abspath(os.path.dirname(__file__)), "config.yml")
 
@@ -40,8 +41,13 @@ parser.add_argument("--ebs", type=int, default=None, help="Evaluation batch size
 
 parser.add_argument("--devices", type=int, nargs="*", default=[0], help="Devices' ids to apply distributed training")
 
+parser.add_argument("--lamb", default=False, action="store_true",
+                    help="Use LAMB optimizer instead of Adam for large batch training")
+
 parser.add_argument("--mxp", default=False, action="store_true", help="Enable mixed precision")
 
+parser.add_argument("--jit", default=False, action="store_true", help="Enable XLA auto clustering to fuse ops")
+
 parser.add_argument("--subwords", type=str, default=None, help="Path to file that stores generated subwords")
 
 parser.add_argument("--subwords_corpus", nargs="*", type=str, default=[], help="Transcript files for generating subwords")
@@ -52,6 +58,8 @@ args = parser.parse_args()
 
 tf.config.optimizer.set_experimental_options({"auto_mixed_precision": args.mxp})
 
+if args.jit: tf.config.optimizer.set_jit(True)  # leave it unset otherwise, so TF_XLA_FLAGS still applies
+
 strategy = setup_strategy(args.devices)
 
 from tensorflow_asr.configs.config import Config
@@ -118,16 +126,27 @@ with conformer_trainer.strategy.scope():
         conformer.summary(line_length=120)
         conformer.add_featurizers(speech_featurizer, text_featurizer) # TODO: Do we need this?
 
-    optimizer = tf.keras.optimizers.Adam(
-        TransformerSchedule(
-            d_model=conformer.dmodel,
-            warmup_steps=config.learning_config.optimizer_config["warmup_steps"],
-            max_lr=(0.05 / math.sqrt(conformer.dmodel))
-        ),
-        beta_1=config.learning_config.optimizer_config["beta1"],
-        beta_2=config.learning_config.optimizer_config["beta2"],
-        epsilon=config.learning_config.optimizer_config["epsilon"]
+    optimizer_config = config.learning_config.optimizer_config
+    learning_rate = TransformerSchedule(
+        d_model=conformer.dmodel,
+        warmup_steps=optimizer_config["warmup_steps"],
+        max_lr=(0.05 / math.sqrt(conformer.dmodel))
     )
+    if args.lamb:
+        optimizer = tfa.optimizers.LAMB(
+            learning_rate,
+            beta_1=optimizer_config["beta1"],
+            beta_2=optimizer_config["beta2"],
+            epsilon=optimizer_config["epsilon"],
+            weight_decay_rate=optimizer_config.get("weight_decay_rate", 1e-4)
+        )
+    else:
+        optimizer = tf.keras.optimizers.Adam(
+            learning_rate,
+            beta_1=optimizer_config["beta1"],
+            beta_2=optimizer_config["beta2"],
+            epsilon=optimizer_config["epsilon"]
+        )
 
 conformer_trainer.compile(model=conformer, optimizer=optimizer,
                           max_to_keep=args.max_ckpts)
@@ -17,6 +17,7 @@ import argparse
 from tensorflow_asr.configs.config import Config
 from tensorflow_asr.utils.utils import preprocess_paths
 from tensorflow_asr.datasets.asr_dataset import ASRTFRecordDataset
+from tensorflow_asr.featurizers.speech_featurizers import TFSpeechFeaturizer
 from tensorflow_asr.featurizers.text_featurizers import SubwordFeaturizer, SentencePieceFeaturizer, CharFeaturizer
 
 parser = argparse.ArgumentParser(prog="TFRecords Creation")
@@ -29,33 +30,55 @@ parser.add_argument("--tfrecords_dir", type=str, default=None, help="Directory t
 
 parser.add_argument("--tfrecords_shards", type=int, default=16, help="Number of tfrecords shards")
 
+parser.add_argument("--compression", type=str, default="ZLIB", choices=["none", "GZIP", "ZLIB"],
+                    help="Compression of tfrecords, set the same compression_type in the dataset configs for training")
+
 parser.add_argument("--shuffle", default=False, action="store_true", help="Shuffle data or not")
 
 parser.add_argument("--sentence_piece", default=False, action="store_true", help="Whether to use `SentencePiece` model")
 
 parser.add_argument("--subwords", type=str, default=None, help="Path to file that stores generated subwords")
 
+parser.add_argument("--cache_features", default=False, action="store_true",
+                    help="Store extracted features (float16) instead of audio")
+
+parser.add_argument("--metadata_prefix", type=str, default=None, help="Path prefix to write metadata (max lengths) to")
+
+parser.add_argument("--num_workers", type=int, default=None,
+                    help="Number of processes writing shards, default to the number of shards")
+
 parser.add_argument("transcripts", nargs="+", type=str, default=None, help="Paths to transcript files")
 
-args = parser.parse_args()
+if __name__ == "__main__":
+    args = parser.parse_args()
+
+    transcripts = list(dict.fromkeys(preprocess_paths(args.transcripts)))  # drop duplicates, keep order
+    tfrecords_dir = preprocess_paths(args.tfrecords_dir)
+
+    config = Config(args.config)
 
-transcripts = preprocess_paths(args.transcripts)
-tfrecords_dir = preprocess_paths(args.tfrecords_dir)
+    if args.sentence_piece:
+        print("Loading SentencePiece model ...")
+        text_featurizer = SentencePieceFeaturizer.load_from_file(config.decoder_config, args.subwords)
+    elif args.subwords and os.path.exists(args.subwords):
+        print("Loading subwords ...")
+        text_featurizer = SubwordFeaturizer.load_from_file(config.decoder_config, args.subwords)
+    else:
+        print("Using character featurizer ...")
+        text_featurizer = CharFeaturizer(config.decoder_config)
 
-config = Config(args.config)
+    if args.cache_features or args.metadata_prefix:
+        speech_featurizer = TFSpeechFeaturizer(config.speech_config)
+    else:
+        speech_featurizer = None
 
-if args.sentence_piece:
-    print("Loading SentencePiece model ...")
-    text_featurizer = SentencePieceFeaturizer.load_from_file(config.decoder_config, args.subwords)
-elif args.subwords and os.path.exists(args.subwords):
-    print("Loading subwords ...")
-    text_featurizer = SubwordFeaturizer.load_from_file(config.decoder_config, args.subwords)
-else:
-    print("Using character featurizer ...")
-    text_featurizer = CharFeaturizer(config.decoder_config)
+    dataset = ASRTFRecordDataset(
+        data_paths=transcripts, tfrecords_dir=tfrecords_dir,
+        speech_featurizer=speech_featurizer, text_featurizer=text_featurizer,
+        stage=args.mode, shuffle=args.shuffle, tfrecords_shards=args.tfrecords_shards,
+        cache_features=args.cache_features, compression_type=args.compression
+    )
+    dataset.create_tfrecords(num_workers=args.num_workers or args.tfrecords_shards)
 
-ASRTFRecordDataset(
-    data_paths=transcripts, tfrecords_dir=tfrecords_dir,
-    speech_featurizer=None, text_featurizer=text_featurizer,
-    stage=args.mode, shuffle=args.shuffle, tfrecords_shards=args.tfrecords_shards
-).create_tfrecords()
+    # Compute metadata once here so training only needs to load it
+    if args.metadata_prefix: dataset.update_metadata(args.metadata_prefix)
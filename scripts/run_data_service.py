@@ -0,0 +1,45 @@
+# Copyright 2020 Huy Le Nguyen (@usimarit)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import argparse
+import tensorflow as tf
+
+parser = argparse.ArgumentParser(prog="tf.data service")
+
+parser.add_argument("--mode", "-m", type=str, choices=["dispatcher", "worker"], default="dispatcher",
+                    help="Run a dispatcher (one per cluster) or a worker (one per feature extraction node)")
+
+parser.add_argument("--port", type=int, default=None,
+                    help="Port of this server, default to 5000 for the dispatcher and 5001 for workers "
+                         "(use a different port for each worker on the same host)")
+
+parser.add_argument("--dispatcher_address", type=str, default=None, help="Address (host:port) of the dispatcher, for workers")
+
+args = parser.parse_args()
+
+if args.port is None: args.port = 5000 if args.mode == "dispatcher" else 5001
+
+if args.mode == "dispatcher":
+    server = tf.data.experimental.service.DispatchServer(
+        tf.data.experimental.service.DispatcherConfig(port=args.port)
+    )
+    print(f"Dispatcher running at {server.target}")
+else:
+    assert args.dispatcher_address is not None, "dispatcher_address must be defined for workers"
+    server = tf.data.experimental.service.WorkerServer(
+        tf.data.experimental.service.WorkerConfig(dispatcher_address=args.dispatcher_address, port=args.port)
+    )
+    print(f"Worker running at port {args.port}, connected to {args.dispatcher_address}")
+
+server.join()
@@ -43,6 +43,9 @@ class TFAugmentationExecutor:
     def __init__(self, augmentations: list):
         self.augmentations = augmentations
 
+    def __len__(self):
+        return len(self.augmentations)  # same as naf.Sometimes, which is a list
+
     @tf.function
     def augment(self, inputs):
         outputs = inputs
@@ -0,0 +1,85 @@
+# Copyright 2020 Huy Le Nguyen (@usimarit)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import shutil
+import tempfile
+import threading
+import tensorflow as tf
+
+
+HDF5_EXTENSIONS = (".h5", ".hdf5", ".keras")
+
+
+class AsyncModelCheckpoint(tf.keras.callbacks.ModelCheckpoint):
+    """
+    Same as ModelCheckpoint but save .h5 files to a local temporary file first, then copy it to `filepath`
+    in a background thread so training is not blocked by slow (cloud) storage.
+    TF format checkpoints are saved directly to `filepath`, because on remote TPUs they are written by the
+    TPU workers, which cannot reach a temporary directory on the coordinator
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(AsyncModelCheckpoint, self).__init__(*args, **kwargs)
+        # relies on private ModelCheckpoint methods, save synchronously if this keras does not have them
+        self.asynchronous = all(
+            callable(getattr(tf.keras.callbacks.ModelCheckpoint, name, None)) for name in ["_get_file_path", "_save_model"]
+        )
+        if not self.asynchronous:
+            print("Warning: ModelCheckpoint internals changed, AsyncModelCheckpoint saves synchronously")
+        self.tmpdir = tempfile.mkdtemp()
+        self.saving = False
+        self.target_path = None
+        self.thread = None
+
+    def _get_file_path(self, *args, **kwargs):
+        filepath = super(AsyncModelCheckpoint, self)._get_file_path(*args, **kwargs)
+        if not self.saving or not str(filepath).endswith(HDF5_EXTENSIONS): return filepath
+        self.target_path = str(filepath)
+        return os.path.join(self.tmpdir, os.path.basename(self.target_path))
+
+    @staticmethod
+    def copy(src: str, dst: str):
+        """ Copy the saved file src to dst """
+        dst_dir = os.path.dirname(dst)
+        if dst_dir: tf.io.gfile.makedirs(dst_dir)
+        tf.io.gfile.copy(src, dst, overwrite=True)
+        print(f"\nCheckpoint copied to {dst}")
+
+    def wait(self):
+        """ Wait for the previous copy to finish """
+        if self.thread is not None: self.thread.join()
+        self.thread = None
+
+    def _save_model(self, *args, **kwargs):
+        if not self.asynchronous: return super(AsyncModelCheckpoint, self)._save_model(*args, **kwargs)
+        self.wait()  # the temporary file is reused, so it must not be overwritten while being copied
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+        os.makedirs(self.tmpdir)
+        self.target_path = None
+        self.saving = True
+        try:
+            super(AsyncModelCheckpoint, self)._save_model(*args, **kwargs)
+        finally:
+            self.saving = False
+        if self.target_path is None: return  # saved directly to filepath (TF format)
+        src = os.path.join(self.tmpdir, os.path.basename(self.target_path))
+        if not os.path.exists(src): return  # nothing written, e.g. when save_best_only and not improved
+        self.thread = threading.Thread(target=self.copy, args=(src, self.target_path), daemon=True)
+        self.thread.start()
+
+    def on_train_end(self, logs=None):
+        self.wait()
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+        super(AsyncModelCheckpoint, self).on_train_end(logs)
@@ -15,13 +15,17 @@
 import os
 import json
 import tqdm
+import functools
+import multiprocessing
 import numpy as np
 import tensorflow as tf
 
 from ..augmentations.augments import Augmentation
-from .base_dataset import BaseDataset, BUFFER_SIZE, TFRECORD_SHARDS, AUTOTUNE
-from ..featurizers.speech_featurizers import load_and_convert_to_wav, read_raw_audio, tf_read_raw_audio, SpeechFeaturizer
-from ..featurizers.text_featurizers import TextFeaturizer
+from .base_dataset import BaseDataset, BUFFER_SIZE, TFRECORD_SHARDS, TFRECORD_BUFFER_SIZE, AUTOTUNE
+from ..featurizers.speech_featurizers import (
+    load_and_convert_to_wav, read_raw_audio, tf_read_raw_audio, tf_is_pcm16_wav, SpeechFeaturizer
+)
+from ..featurizers.text_featurizers import TextFeaturizer, CharFeaturizer
 from ..utils.utils import bytestring_feature, get_num_batches, preprocess_paths
 
 
@@ -40,6 +44,8 @@ class ASRDataset(BaseDataset):
                  drop_remainder: bool = True,
                  use_tf: bool = False,
                  buffer_size: int = BUFFER_SIZE,
+                 bucket_boundaries: list = None,
+                 raw_audio: bool = False,
                  **kwargs):
         super(ASRDataset, self).__init__(
             data_paths=data_paths, augmentations=augmentations,
@@ -48,6 +54,11 @@ class ASRDataset(BaseDataset):
         )
         self.speech_featurizer = speech_featurizer
         self.text_featurizer = text_featurizer
+        self.bucket_boundaries = sorted(bucket_boundaries) if bucket_boundaries else None  # input lengths to bucket by
+        self.raw_audio = raw_audio  # whether to emit raw signals and leave feature extraction to the model
+        if self.raw_audio and not self.use_tf: raise ValueError("raw_audio requires use_tf")
+        if self.raw_audio and self.augmentations.after.augmentations:
+            print("Warning: features augmentations are not applied when features are extracted by the model")
 
     # -------------------------------- metadata -------------------------------------
 
@@ -106,8 +117,20 @@ class ASRDataset(BaseDataset):
                 self.entries += temp_lines[1:]
         # The files is "\t" seperated
         self.entries = [line.split("\t", 2) for line in self.entries]
-        for i, line in enumerate(self.entries):
-            self.entries[i][-1] = " ".join([str(x) for x in self.text_featurizer.extract(line[-1]).numpy()])
+        for line in self.entries: line[0] = os.path.expanduser(line[0])  # tf.io.read_file does not expand "~"
+        if isinstance(self.text_featurizer, CharFeaturizer) and len(self.entries) > 0:
+            # tokenize all transcripts at once with tf ops instead of one by one
+            texts = [self.text_featurizer.preprocess_text(line[-1]) for line in self.entries]
+            indices = self.text_featurizer.tf_extract(tf.constant(texts, dtype=tf.string))
+            if tf.reduce_any(indices.flat_values < 0):
+                raise ValueError("transcripts contain characters that are not in the vocabulary")
+            indices = tf.strings.reduce_join(tf.ragged.map_flat_values(tf.strings.as_string, indices), axis=-1, separator=" ")
+            indices = indices.numpy()
+            for i, line in enumerate(self.entries):
+                self.entries[i][-1] = indices[i].decode("utf-8")
+        else:
+            for i, line in enumerate(self.entries):
+                self.entries[i][-1] = " ".join([str(x) for x in self.text_featurizer.extract(line[-1]).numpy()])
         self.entries = np.array(self.entries)
         if self.shuffle: np.random.shuffle(self.entries)  # Mix transcripts.tsv
         self.total_steps = len(self.entries)
@@ -119,6 +142,14 @@ class ASRDataset(BaseDataset):
             audio = load_and_convert_to_wav(path).numpy()
             yield bytes(path, "utf-8"), audio, bytes(indices, "utf-8")
 
+    def tf_label(self, indices: tf.Tensor):
+        """ Label, label_length, prediction (label prepended with blank) and prediction_length from indices """
+        label = tf.strings.to_number(tf.strings.split(indices), out_type=tf.int32)
+        label_length = tf.cast(tf.shape(label)[0], tf.int32)
+        prediction = self.text_featurizer.prepand_blank(label)
+        prediction_length = tf.cast(tf.shape(prediction)[0], tf.int32)
+        return label, label_length, prediction, prediction_length
+
     def preprocess(self, path: tf.Tensor, audio: tf.Tensor, indices: tf.Tensor):
         with tf.device("/CPU:0"):
             def fn(_path: bytes, _audio: bytes, _indices: bytes):
@@ -130,10 +161,7 @@ class ASRDataset(BaseDataset):
 
                 features = self.augmentations.after.augment(features)
 
-                label = tf.strings.to_number(tf.strings.split(_indices), out_type=tf.int32)
-                label_length = tf.cast(tf.shape(label)[0], tf.int32)
-                prediction = self.text_featurizer.prepand_blank(label)
-                prediction_length = tf.cast(tf.shape(prediction)[0], tf.int32)
+                label, label_length, prediction, prediction_length = self.tf_label(_indices)
                 features = tf.convert_to_tensor(features, tf.float32)
                 input_length = tf.cast(tf.shape(features)[0], tf.int32)
 
@@ -154,10 +182,7 @@ class ASRDataset(BaseDataset):
 
             features = self.augmentations.after.augment(features)
 
-            label = tf.strings.to_number(tf.strings.split(indices), out_type=tf.int32)
-            label_length = tf.cast(tf.shape(label)[0], tf.int32)
-            prediction = self.text_featurizer.prepand_blank(label)
-            prediction_length = tf.cast(tf.shape(prediction)[0], tf.int32)
+            label, label_length, prediction, prediction_length = self.tf_label(indices)
             features = tf.convert_to_tensor(features, tf.float32)
             input_length = tf.cast(tf.shape(features)[0], tf.int32)
 
@@ -234,6 +259,8 @@ class ASRTFRecordDataset(ASRDataset):
                  indefinite: bool = False,
                  drop_remainder: bool = True,
                  buffer_size: int = BUFFER_SIZE,
+                 cache_features: bool = False,
+                 compression_type: str = "ZLIB",
                  **kwargs):
         super(ASRTFRecordDataset, self).__init__(
             stage=stage, speech_featurizer=speech_featurizer, text_featurizer=text_featurizer,
@@ -244,10 +271,15 @@ class ASRTFRecordDataset(ASRDataset):
         self.tfrecords_dir = tfrecords_dir
         if tfrecords_shards <= 0: raise ValueError("tfrecords_shards must be positive")
         self.tfrecords_shards = tfrecords_shards
+        self.cache_features = cache_features  # whether tfrecords store extracted features instead of audio
+        self.compression_type = "" if compression_type in (None, "", "none") else compression_type.upper()
+        if self.compression_type not in ("", "GZIP", "ZLIB"):
+            raise ValueError("compression_type must be either 'none', 'GZIP' or 'ZLIB'")
         if not tf.io.gfile.exists(self.tfrecords_dir): tf.io.gfile.makedirs(self.tfrecords_dir)
 
     @staticmethod
-    def write_tfrecord_file(splitted_entries):
+    def write_tfrecord_file(splitted_entries, speech_featurizer: SpeechFeaturizer = None, compression_type: str = "ZLIB"):
+        """ Write entries to a shard, store float16 features instead of audio if speech_featurizer is given """
         shard_path, entries = splitted_entries
 
         def parse(record):
@@ -255,21 +287,28 @@ class ASRTFRecordDataset(ASRDataset):
                 audio = load_and_convert_to_wav(path.decode("utf-8")).numpy()
                 feature = {
                     "path": bytestring_feature([path]),
-                    "audio": bytestring_feature([audio]),
                     "indices": bytestring_feature([indices])
                 }
+                if speech_featurizer is None:
+                    feature["audio"] = bytestring_feature([audio])
+                else:
+                    signal = read_raw_audio(audio, sample_rate=speech_featurizer.sample_rate)
+                    features = speech_featurizer.extract(signal).astype(np.float16)
+                    feature["features"] = bytestring_feature([tf.io.serialize_tensor(features).numpy()])
                 example = tf.train.Example(features=tf.train.Features(feature=feature))
                 return example.SerializeToString()
             return tf.numpy_function(fn, inp=[record[0], record[2]], Tout=tf.string)
 
         dataset = tf.data.Dataset.from_tensor_slices(entries)
         dataset = dataset.map(parse, num_parallel_calls=AUTOTUNE)
-        writer = tf.data.experimental.TFRecordWriter(shard_path, compression_type="ZLIB")
+        writer = tf.data.experimental.TFRecordWriter(shard_path, compression_type=compression_type)
         print(f"Processing {shard_path} ...")
         writer.write(dataset)
         print(f"Created {shard_path}")
 
-    def create_tfrecords(self):
+    def create_tfrecords(self, num_workers: int = 1):
+        """ Create tfrecords shards, written by `num_workers` processes in parallel
+        (num_workers > 1 spawns processes, so the calling script must be guarded by `if __name__ == "__main__"`) """
         if not tf.io.gfile.exists(self.tfrecords_dir):
             tf.io.gfile.makedirs(self.tfrecords_dir)
 
@@ -288,18 +327,59 @@ class ASRTFRecordDataset(ASRDataset):
         shards = [get_shard_path(idx) for idx in range(1, self.tfrecords_shards + 1)]
 
         splitted_entries = np.array_split(self.entries, self.tfrecords_shards)
-        for entries in zip(shards, splitted_entries):
-            self.write_tfrecord_file(entries)
+        speech_featurizer = self.speech_featurizer if self.cache_features else None
+        num_workers = max(1, min(num_workers, self.tfrecords_shards, multiprocessing.cpu_count()))
+        if num_workers == 1:
+            for entries in zip(shards, splitted_entries):
+                self.write_tfrecord_file(entries, speech_featurizer=speech_featurizer,
+                                         compression_type=self.compression_type)
+        else:
+            write_fn = functools.partial(ASRTFRecordDataset.write_tfrecord_file, speech_featurizer=speech_featurizer,
+                                         compression_type=self.compression_type)
+            # spawn instead of fork because tensorflow runtime is not fork-safe
+            # the writers only run cpu work, hide gpus from them before they import tensorflow
+            # (speech_featurizers initializes the runtime on import), otherwise each one reserves gpu memory
+            cuda_visible_devices = os.environ.get("CUDA_VISIBLE_DEVICES")
+            os.environ["CUDA_VISIBLE_DEVICES"] = ""
+            try:
+                with multiprocessing.get_context("spawn").Pool(num_workers) as pool:
+                    pool.map(write_fn, zip(shards, splitted_entries))
+            finally:
+                if cuda_visible_devices is None: del os.environ["CUDA_VISIBLE_DEVICES"]
+                else: os.environ["CUDA_VISIBLE_DEVICES"] = cuda_visible_devices
 
         return True
 
-    def parse(self, record: tf.Tensor):
-        feature_description = {
+    @property
+    def feature_description(self) -> dict:
+        return {
             "path": tf.io.FixedLenFeature([], tf.string),
-            "audio": tf.io.FixedLenFeature([], tf.string),
+            ("features" if self.cache_features else "audio"): tf.io.FixedLenFeature([], tf.string),
             "indices": tf.io.FixedLenFeature([], tf.string)
         }
-        example = tf.io.parse_single_example(record, feature_description)
+
+    def features_augment(self, augmentations, features: tf.Tensor):
+        """ Apply features augmentations, through tf.numpy_function if not use_tf """
+        if self.use_tf: return augmentations.augment(features)
+        features = tf.numpy_function(augmentations.augment, inp=[features], Tout=tf.float32)
+        return tf.reshape(features, [-1] + self.speech_featurizer.shape[1:])
+
+    def features_preprocess(self, path: tf.Tensor, features: tf.Tensor, indices: tf.Tensor):
+        """ Same as tf_preprocess but for tfrecords storing extracted features """
+        with tf.device("/CPU:0"):
+            features = tf.io.parse_tensor(features, out_type=tf.float16)
+            features = tf.reshape(tf.cast(features, tf.float32), [-1] + self.speech_featurizer.shape[1:])
+
+            features = self.features_augment(self.augmentations.after, features)
+
+            label, label_length, prediction, prediction_length = self.tf_label(indices)
+            input_length = tf.cast(tf.shape(features)[0], tf.int32)
+
+            return path, features, input_length, label, label_length, prediction, prediction_length
+
+    def parse(self, record: tf.Tensor):
+        example = tf.io.parse_single_example(record, self.feature_description)
+        if self.cache_features: return self.features_preprocess(**example)
         if self.use_tf: return self.tf_preprocess(**example)
         return self.preprocess(**example)
 
@@ -308,11 +388,14 @@ class ASRTFRecordDataset(ASRDataset):
         if not have_data: return None
 
         pattern = os.path.join(self.tfrecords_dir, f"{self.stage}*.tfrecord")
-        files_ds = tf.data.Dataset.list_files(pattern)
-        ignore_order = tf.data.Options()
-        ignore_order.experimental_deterministic = False
-        files_ds = files_ds.with_options(ignore_order)
-        dataset = tf.data.TFRecordDataset(files_ds, compression_type="ZLIB", num_parallel_reads=AUTOTUNE)
+        files_ds = tf.data.Dataset.list_files(pattern, shuffle=self.shuffle)
+        # read all shards concurrently, in any order
+        dataset = files_ds.interleave(
+            lambda path: tf.data.TFRecordDataset(
+                path, compression_type=self.compression_type, buffer_size=TFRECORD_BUFFER_SIZE
+            ),
+            cycle_length=self.tfrecords_shards, num_parallel_calls=AUTOTUNE, deterministic=False
+        )
 
         return self.process(dataset, batch_size)
 
@@ -322,8 +405,20 @@ class ASRSliceDataset(ASRDataset):
 
     @staticmethod
     def load(record: tf.Tensor):
+        """ Read 16-bit PCM wav files with tf ops so loading runs in parallel without the GIL,
+        other files (formats, bit depths) are converted to 16-bit PCM wav with librosa """
         def fn(path: bytes): return load_and_convert_to_wav(path.decode("utf-8")).numpy()
-        audio = tf.numpy_function(fn, inp=[record[0]], Tout=tf.string)
+
+        def convert(): return tf.numpy_function(fn, inp=[record[0]], Tout=tf.string)
+
+        def read_wav():
+            audio = tf.io.read_file(record[0])
+            return tf.cond(tf_is_pcm16_wav(audio), true_fn=lambda: audio, false_fn=convert)
+
+        audio = tf.cond(
+            tf.strings.regex_full_match(tf.strings.lower(record[0]), r".*\.wav"),
+            true_fn=read_wav, false_fn=convert
+        )
         return record[0], audio, record[2]
 
     def create(self, batch_size: int):
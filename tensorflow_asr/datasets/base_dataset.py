@@ -19,6 +19,7 @@ from ..augmentations.augments import Augmentation
 
 BUFFER_SIZE = 100
 TFRECORD_SHARDS = 16
+TFRECORD_BUFFER_SIZE = 8 * 1024 * 1024  # bytes read ahead for each shard
 AUTOTUNE = tf.data.experimental.AUTOTUNE
 
 
@@ -12,11 +12,12 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import os
 import tensorflow as tf
 
 from ..asr_dataset import ASRDataset, ASRTFRecordDataset, ASRSliceDataset, AUTOTUNE, TFRECORD_SHARDS
 from ..base_dataset import BUFFER_SIZE
-from ...featurizers.speech_featurizers import SpeechFeaturizer
+from ...featurizers.speech_featurizers import SpeechFeaturizer, tf_read_raw_audio
 from ...featurizers.text_featurizers import TextFeaturizer
 from ...utils.utils import get_num_batches
 from ...augmentations.augments import Augmentation
@@ -30,11 +31,32 @@ class ASRDatasetKeras(ASRDataset):
         Returns:
             path, features, input_lengths, labels, label_lengths, pred_inp
         """
-        if self.use_tf: data = self.tf_preprocess(path, audio, indices)
+        if self.raw_audio: data = self.raw_preprocess(path, audio, indices)
+        elif self.use_tf: data = self.tf_preprocess(path, audio, indices)
         else: data = self.preprocess(path, audio, indices)
+        return self.to_keras_data(*data)
 
-        _, features, input_length, label, label_length, prediction, prediction_length = data
+    def raw_preprocess(self, path: tf.Tensor, audio: tf.Tensor, indices: tf.Tensor):
+        """ Same as tf_preprocess but return the signal, features are extracted by the model
+        (see Transducer.add_feature_extraction), input_length is still the number of frames """
+        with tf.device("/CPU:0"):
+            signal = tf_read_raw_audio(audio, self.speech_featurizer.sample_rate)
 
+            signal = self.augmentations.before.augment(signal)
+
+            label, label_length, prediction, prediction_length = self.tf_label(indices)
+            input_length = tf.cast(self.speech_featurizer.get_length_from_samples(tf.shape(signal)[0]), tf.int32)
+
+            return path, signal, input_length, label, label_length, prediction, prediction_length
+
+    @property
+    def input_shape(self) -> list:
+        if self.raw_audio: return self.speech_featurizer.signal_shape
+        return self.speech_featurizer.shape
+
+    @staticmethod
+    def to_keras_data(path, features, input_length, label, label_length, prediction, prediction_length):
+        """ Convert preprocessed data to keras (inputs, targets) """
         return (
             {
                 "input": features,
@@ -48,9 +70,60 @@ class ASRDatasetKeras(ASRDataset):
             }
         )
 
+    def padded_shapes(self, input_shape: list):
+        return (
+            {
+                "input": tf.TensorShape(input_shape),
+                "input_length": tf.TensorShape([]),
+                "prediction": tf.TensorShape(self.text_featurizer.prepand_shape),
+                "prediction_length": tf.TensorShape([])
+            },
+            {
+                "label": tf.TensorShape(self.text_featurizer.shape),
+                "label_length": tf.TensorShape([])
+            },
+        )
+
+    @property
+    def padding_values(self):
+        return (
+            {
+                "input": 0.,
+                "input_length": 0,
+                "prediction": self.text_featurizer.blank,
+                "prediction_length": 0
+            },
+            {
+                "label": self.text_featurizer.blank,
+                "label_length": 0
+            }
+        )
+
+    def bucket_batch(self, dataset: tf.data.Dataset, batch_size: int):
+        """ Batch utterances of similar input lengths together to reduce padding
+        Batches are padded to their bucket boundaries when the max input length is known from metadata """
+        bucket_boundaries = list(self.bucket_boundaries)
+        max_length = self.speech_featurizer.max_length
+        if max_length >= bucket_boundaries[-1]: bucket_boundaries.append(max_length + 1)
+        return dataset.apply(
+            tf.data.experimental.bucket_by_sequence_length(
+                element_length_func=lambda inputs, targets: inputs["input_length"],
+                bucket_boundaries=bucket_boundaries,
+                bucket_batch_sizes=[batch_size] * (len(bucket_boundaries) + 1),
+                padded_shapes=self.padded_shapes([None] + self.input_shape[1:]),
+                padding_values=self.padding_values,
+                # boundaries count frames, they cannot be used to pad raw signals
+                pad_to_bucket_boundary=(max_length > 0 and not self.raw_audio),
+                drop_remainder=self.drop_remainder
+            )
+        )
+
     def process(self, dataset, batch_size):
         dataset = dataset.map(self.parse, num_parallel_calls=AUTOTUNE)
+        return self.batch(dataset, batch_size)
 
+    def batch(self, dataset: tf.data.Dataset, batch_size: int):
+        """ Cache, shuffle, repeat, batch and prefetch the parsed dataset """
         if self.cache:
             dataset = dataset.cache()
 
@@ -60,35 +133,21 @@ class ASRDatasetKeras(ASRDataset):
         if self.indefinite:
             dataset = dataset.repeat()
 
-        # PADDED BATCH the dataset
-        dataset = dataset.padded_batch(
-            batch_size=batch_size,
-            padded_shapes=(
-                {
-                    "input": tf.TensorShape(self.speech_featurizer.shape),
-                    "input_length": tf.TensorShape([]),
-                    "prediction": tf.TensorShape(self.text_featurizer.prepand_shape),
-                    "prediction_length": tf.TensorShape([])
-                },
-                {
-                    "label": tf.TensorShape(self.text_featurizer.shape),
-                    "label_length": tf.TensorShape([])
-                },
-            ),
-            padding_values=(
-                {
-                    "input": 0.,
-                    "input_length": 0,
-                    "prediction": self.text_featurizer.blank,
-                    "prediction_length": 0
-                },
-                {
-                    "label": self.text_featurizer.blank,
-                    "label_length": 0
-                }
-            ),
-            drop_remainder=self.drop_remainder
-        )
+        if self.bucket_boundaries:
+            dataset = self.bucket_batch(dataset, batch_size)
+        else:
+            # PADDED BATCH the dataset
+            dataset = dataset.padded_batch(
+                batch_size=batch_size,
+                padded_shapes=self.padded_shapes(self.input_shape),
+                padding_values=self.padding_values,
+                drop_remainder=self.drop_remainder
+            )
+
+        # Fuse consecutive maps so the featurization runs as one function
+        options = tf.data.Options()
+        options.experimental_optimization.map_fusion = True
+        dataset = dataset.with_options(options)
 
         # PREFETCH to improve speed of input length
         dataset = dataset.prefetch(AUTOTUNE)
@@ -113,31 +172,64 @@ class ASRTFRecordDatasetKeras(ASRDatasetKeras, ASRTFRecordDataset):
                  indefinite: bool = False,
                  drop_remainder: bool = True,
                  buffer_size: int = BUFFER_SIZE,
+                 cache_features: bool = False,
+                 compression_type: str = "ZLIB",
+                 bucket_boundaries: list = None,
+                 raw_audio: bool = False,
+                 snapshot: bool = False,
                  **kwargs):
         ASRTFRecordDataset.__init__(
             self, stage=stage, speech_featurizer=speech_featurizer, text_featurizer=text_featurizer,
             data_paths=data_paths, tfrecords_dir=tfrecords_dir, augmentations=augmentations, cache=cache, shuffle=shuffle,
             tfrecords_shards=tfrecords_shards, drop_remainder=drop_remainder, buffer_size=buffer_size, use_tf=use_tf,
-            indefinite=indefinite
+            indefinite=indefinite, cache_features=cache_features, compression_type=compression_type
         )
         ASRDatasetKeras.__init__(
             self, stage=stage, speech_featurizer=speech_featurizer, text_featurizer=text_featurizer,
             data_paths=data_paths, augmentations=augmentations, cache=cache, shuffle=shuffle,
             drop_remainder=drop_remainder, buffer_size=buffer_size, use_tf=use_tf,
-            indefinite=indefinite
+            indefinite=indefinite, bucket_boundaries=bucket_boundaries, raw_audio=raw_audio
         )
+        if self.cache_features and self.raw_audio: raise ValueError("cache_features and raw_audio cannot be both set")
+        self.snapshot = snapshot  # whether to persist extracted features to tfrecords_dir on the first epoch
+        if self.snapshot:
+            # features are extracted without augmentations before the snapshot and augmented after it,
+            # so augmentations still differ every epoch
+            if len(self.augmentations.before) > 0:
+                print("Warning: signal augmentations are not applied when features are snapshotted")
+            self.features_augmentations = self.augmentations.after
+            self.augmentations = Augmentation(None, use_tf=self.use_tf)
+
+    @property
+    def snapshot_dir(self) -> str:
+        return os.path.join(self.tfrecords_dir, "_snapshot", self.stage)
 
     def parse(self, record: tf.Tensor):
-        feature_description = {
-            "path": tf.io.FixedLenFeature([], tf.string),
-            "audio": tf.io.FixedLenFeature([], tf.string),
-            "indices": tf.io.FixedLenFeature([], tf.string)
-        }
-        example = tf.io.parse_single_example(record, feature_description)
+        example = tf.io.parse_single_example(record, self.feature_description)
+        if self.cache_features: return self.to_keras_data(*self.features_preprocess(**example))
         return ASRDatasetKeras.parse(self, **example)
 
+    def augment(self, inputs: dict, targets: dict):
+        """ Apply features augmentations on snapshotted data """
+        if self.raw_audio: return inputs, targets
+        features = self.features_augment(self.features_augmentations, inputs["input"])
+        return dict(inputs, input=features), targets
+
     def process(self, dataset: tf.data.Dataset, batch_size: int):
-        return ASRDatasetKeras.process(self, dataset, batch_size)
+        if not self.snapshot: return ASRDatasetKeras.process(self, dataset, batch_size)
+
+        dataset = dataset.map(self.parse, num_parallel_calls=AUTOTUNE)
+        dataset = dataset.apply(
+            tf.data.experimental.snapshot(
+                self.snapshot_dir, compression="AUTO",
+                # read the snapshot shards in parallel
+                reader_func=lambda datasets: datasets.interleave(
+                    lambda x: x, num_parallel_calls=AUTOTUNE, deterministic=False
+                )
+            )
+        )
+        dataset = dataset.map(self.augment, num_parallel_calls=AUTOTUNE)
+        return self.batch(dataset, batch_size)
 
 
 class ASRSliceDatasetKeras(ASRDatasetKeras, ASRSliceDataset):
@@ -155,6 +247,8 @@ class ASRSliceDatasetKeras(ASRDatasetKeras, ASRSliceDataset):
                  indefinite: bool = False,
                  drop_remainder: bool = True,
                  buffer_size: int = BUFFER_SIZE,
+                 bucket_boundaries: list = None,
+                 raw_audio: bool = False,
                  **kwargs):
         ASRSliceDataset.__init__(
             self, stage=stage, speech_featurizer=speech_featurizer, text_featurizer=text_featurizer,
@@ -166,7 +260,7 @@ class ASRSliceDatasetKeras(ASRDatasetKeras, ASRSliceDataset):
             self, stage=stage, speech_featurizer=speech_featurizer, text_featurizer=text_featurizer,
             data_paths=data_paths, augmentations=augmentations, cache=cache, shuffle=shuffle,
             drop_remainder=drop_remainder, buffer_size=buffer_size, use_tf=use_tf,
-            indefinite=indefinite
+            indefinite=indefinite, bucket_boundaries=bucket_boundaries, raw_audio=raw_audio
         )
 
     def parse(self, path: tf.Tensor, audio: tf.Tensor, indices: tf.Tensor):
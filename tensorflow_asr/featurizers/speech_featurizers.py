@@ -66,6 +66,31 @@ def tf_read_raw_audio(audio: tf.Tensor, sample_rate=16000):
     return tf.reshape(wave, shape=[-1])  # reshape for using tf.signal
 
 
+def tf_is_pcm16_wav(audio: tf.Tensor) -> tf.Tensor:
+    """
+    Whether audio bytes are a canonical mono 16-bit PCM wav, which tf.audio.decode_wav reads the same way as librosa
+    (decode_wav only reads 16-bit PCM, and keeps the first channel instead of averaging them)
+    Args:
+        audio: tf.Tensor of dtype tf.string with shape []
+
+    Returns:
+        tf.Tensor of dtype tf.bool with shape []
+    """
+    # pad so that truncated headers are read as zeros instead of failing
+    header = tf.strings.substr(tf.strings.join([tf.strings.substr(audio, 0, 36), "\0" * 36]), 0, 36)
+    audio_format = tf.io.decode_raw(tf.strings.substr(header, 20, 2), tf.uint16)[0]
+    num_channels = tf.io.decode_raw(tf.strings.substr(header, 22, 2), tf.uint16)[0]
+    bits_per_sample = tf.io.decode_raw(tf.strings.substr(header, 34, 2), tf.uint16)[0]
+    return tf.reduce_all(tf.stack([
+        tf.equal(tf.strings.substr(header, 0, 4), "RIFF"),
+        tf.equal(tf.strings.substr(header, 8, 4), "WAVE"),
+        tf.equal(tf.strings.substr(header, 12, 4), "fmt "),
+        tf.equal(audio_format, 1),  # WAVE_FORMAT_PCM
+        tf.equal(num_channels, 1),
+        tf.equal(bits_per_sample, 16)
+    ]))
+
+
 def slice_signal(signal, window_size, stride=0.5) -> np.ndarray:
     """ Return windows of the given signal by sweeping in stride fractions of window """
     assert signal.ndim == 1, signal.ndim
@@ -128,12 +153,12 @@ def tf_normalize_signal(signal: tf.Tensor):
     """
     TF Normailize signal to [-1, 1] range
     Args:
-        signal: tf.Tensor with shape [None]
+        signal: tf.Tensor with shape [None] or [B, None]
 
     Returns:
-        normalized signal with shape [None]
+        normalized signal with the same shape
     """
-    gain = 1.0 / (tf.reduce_max(tf.abs(signal), axis=-1) + 1e-9)
+    gain = 1.0 / (tf.reduce_max(tf.abs(signal), axis=-1, keepdims=True) + 1e-9)
     return signal * gain
 
 
@@ -147,15 +172,15 @@ def tf_preemphasis(signal: tf.Tensor, coeff=0.97):
     """
     TF Pre-emphasis
     Args:
-        signal: tf.Tensor with shape [None]
+        signal: tf.Tensor with shape [None] or [B, None]
         coeff: Float that indicates the preemphasis coefficient
 
     Returns:
-        pre-emphasized signal with shape [None]
+        pre-emphasized signal with the same shape
     """
     if not coeff or coeff <= 0.0: return signal
-    s0 = tf.expand_dims(signal[0], axis=-1)
-    s1 = signal[1:] - coeff * signal[:-1]
+    s0 = signal[..., :1]
+    s1 = signal[..., 1:] - coeff * signal[..., :-1]
     return tf.concat([s0, s1], axis=-1)
 
 
@@ -235,8 +260,18 @@ class SpeechFeaturizer(metaclass=abc.ABCMeta):
         """ The shape of extracted features """
         raise NotImplementedError()
 
+    @property
+    def signal_shape(self) -> list:
+        """ The shape of raw signals, padded to the longest signal that yields max_length frames """
+        if self.max_length <= 0: return [None]
+        return [self.max_length * self.frame_step - 1 + (0 if self.center else self.nfft)]
+
     def get_length_from_duration(self, duration):
         nsamples = math.ceil(float(duration) * self.sample_rate)
+        return self.get_length_from_samples(nsamples)
+
+    def get_length_from_samples(self, nsamples):
+        """ Number of frames of a signal with nsamples samples, nsamples can be either an int or a tf.Tensor """
         if self.center: nsamples += self.nfft
         return 1 + (nsamples - self.nfft) // self.frame_step  # https://www.tensorflow.org/api_docs/python/tf/signal/frame
 
@@ -417,7 +452,10 @@ class TFSpeechFeaturizer(SpeechFeaturizer):
         return [length, self.num_feature_bins, 1]
 
     def stft(self, signal):
-        if self.center: signal = tf.pad(signal, [[self.nfft // 2, self.nfft // 2]], mode="REFLECT")
+        """ Power spectrogram of signal with shape [None] or [B, None] """
+        if self.center:
+            paddings = [[0, 0]] * (len(signal.shape) - 1) + [[self.nfft // 2, self.nfft // 2]]
+            signal = tf.pad(signal, paddings, mode="REFLECT")
         window = tf.signal.hann_window(self.frame_length, periodic=True)
         left_pad = (self.nfft - self.frame_length) // 2
         right_pad = self.nfft - self.frame_length - left_pad
@@ -444,7 +482,8 @@ class TFSpeechFeaturizer(SpeechFeaturizer):
         if top_db is not None:
             if top_db < 0:
                 raise ValueError('top_db must be non-negative')
-            log_spec = tf.maximum(log_spec, tf.reduce_max(log_spec) - top_db)
+            # max over each spectrogram [T, F], so batched spectrograms are clipped independently
+            log_spec = tf.maximum(log_spec, tf.reduce_max(log_spec, axis=[-2, -1], keepdims=True) - top_db)
 
         return log_spec
 
@@ -466,16 +505,7 @@ class TFSpeechFeaturizer(SpeechFeaturizer):
             signal = tf_normalize_signal(signal)
         signal = tf_preemphasis(signal, self.preemphasis)
 
-        if self.feature_type == "spectrogram":
-            features = self.compute_spectrogram(signal)
-        elif self.feature_type == "log_mel_spectrogram":
-            features = self.compute_log_mel_spectrogram(signal)
-        elif self.feature_type == "mfcc":
-            features = self.compute_mfcc(signal)
-        elif self.feature_type == "log_gammatone_spectrogram":
-            features = self.compute_log_gammatone_spectrogram(signal)
-        else:
-            raise ValueError("feature_type must be either 'mfcc', 'log_mel_spectrogram' or 'spectrogram'")
+        features = self.compute_features(signal)
 
         features = tf.expand_dims(features, axis=-1)
 
@@ -484,6 +514,18 @@ class TFSpeechFeaturizer(SpeechFeaturizer):
 
         return features
 
+    def compute_features(self, signal):
+        """ Compute features of type feature_type from signal with shape [None] or [B, None] """
+        if self.feature_type == "spectrogram":
+            return self.compute_spectrogram(signal)
+        if self.feature_type == "log_mel_spectrogram":
+            return self.compute_log_mel_spectrogram(signal)
+        if self.feature_type == "mfcc":
+            return self.compute_mfcc(signal)
+        if self.feature_type == "log_gammatone_spectrogram":
+            return self.compute_log_gammatone_spectrogram(signal)
+        raise ValueError("feature_type must be either 'mfcc', 'log_mel_spectrogram' or 'spectrogram'")
+
     def compute_log_mel_spectrogram(self, signal):
         spectrogram = self.stft(signal)
         linear_to_weight_matrix = tf.signal.linear_to_mel_weight_matrix(
@@ -498,7 +540,7 @@ class TFSpeechFeaturizer(SpeechFeaturizer):
     def compute_spectrogram(self, signal):
         S = self.stft(signal)
         spectrogram = self.power_to_db(S)
-        return spectrogram[:, :self.num_feature_bins]
+        return spectrogram[..., :self.num_feature_bins]
 
     def compute_mfcc(self, signal):
         log_mel_spectrogram = self.compute_log_mel_spectrogram(signal)
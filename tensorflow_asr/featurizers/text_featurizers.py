@@ -152,6 +152,35 @@ class CharFeaturizer(TextFeaturizer):
         indices = [self.tokens2indices[token] for token in text]
         return tf.convert_to_tensor(indices, dtype=tf.int32)
 
+    @property
+    def table(self) -> tf.lookup.StaticHashTable:
+        """ Lookup table from characters to indices, -1 for characters not in the vocabulary """
+        if getattr(self, "_table", None) is None:
+            self._table = tf.lookup.StaticHashTable(
+                tf.lookup.KeyValueTensorInitializer(
+                    keys=list(self.tokens2indices.keys()),
+                    values=list(self.tokens2indices.values()),
+                    key_dtype=tf.string, value_dtype=tf.int32
+                ),
+                default_value=-1
+            )
+        return self._table
+
+    def tf_extract(self, text: tf.Tensor) -> tf.Tensor:
+        """
+        Convert strings to integers with tf ops, same as extract except the unicode normalization
+        Args:
+            text: tf.Tensor of dtype tf.string with dim [] or [B]
+
+        Returns:
+            sequence of ints in tf.Tensor with dim [None], or tf.RaggedTensor with dim [B, None]
+        """
+        text = tf.strings.strip(tf.strings.lower(text, encoding="utf-8"))
+        chars = tf.strings.unicode_split(text, "UTF-8")
+        if isinstance(chars, tf.RaggedTensor):
+            return tf.ragged.map_flat_values(self.table.lookup, chars)
+        return self.table.lookup(chars)
+
     def iextract(self, indices: tf.Tensor) -> tf.Tensor:
         """
         Convert list of indices to string
@@ -29,6 +29,7 @@ except ImportError:
 
 
 def rnnt_loss(logits, labels, label_length, logit_length, blank=0, name=None):
+    logits = tf.cast(logits, tf.float32)  # always compute the loss in float32 under mixed precision
     if use_warprnnt:
         return rnnt_loss_warprnnt(logits=logits, labels=labels,
                                   label_length=label_length, logit_length=logit_length, blank=blank)
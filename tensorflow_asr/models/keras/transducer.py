@@ -19,14 +19,22 @@ from tensorflow.keras import mixed_precision as mxp
 from ..transducer import Transducer as BaseTransducer
 from ...utils.utils import get_reduced_length
 from ...losses.keras.rnnt_losses import RnntLoss
+from ..layers.feature_extraction import SpeechFeatureExtraction
 
 
 class Transducer(BaseTransducer):
     """ Keras Transducer Model Warper """
+    feature_extraction = None  # set by add_feature_extraction to consume raw signals
+
     @property
     def metrics(self):
         return [self.loss_metric]
 
+    def add_feature_extraction(self, speech_config: dict):
+        """ Extract features from raw signals inside the model, must be called before _build
+        The input is then the raw signal and input_length the number of frames """
+        self.feature_extraction = SpeechFeatureExtraction(speech_config, name=f"{self.name}_feature_extraction")
+
     def _build(self, input_shape, prediction_shape=[None], batch_size=None):
         inputs = tf.keras.Input(shape=input_shape, batch_size=batch_size, dtype=tf.float32)
         input_length = tf.keras.Input(shape=[], batch_size=batch_size, dtype=tf.int32)
@@ -41,24 +49,71 @@ class Transducer(BaseTransducer):
 
     def call(self, inputs, training=False, **kwargs):
         features = inputs["input"]
+        if self.feature_extraction is not None:
+            features = self.feature_extraction([features, inputs["input_length"]], training=training)
         prediction = inputs["prediction"]
         prediction_length = inputs["prediction_length"]
         enc = self.encoder(features, training=training, **kwargs)
         pred = self.predict_net([prediction, prediction_length], training=training, **kwargs)
         outputs = self.joint_net([enc, pred], training=training, **kwargs)
         return {
-            "logit": outputs,
+            "logit": tf.cast(outputs, tf.float32),  # keep logits in float32 for the loss under mixed precision
             "logit_length": get_reduced_length(inputs["input_length"], self.time_reduction_factor)
         }
 
-    def compile(self, optimizer, global_batch_size, blank=0, use_loss_scale=False, run_eagerly=None, **kwargs):
+    def compile(self, optimizer, global_batch_size, blank=0, use_loss_scale=False,
+                unrolled_steps_per_execution=1, allreduce_dtype=None, run_eagerly=None, **kwargs):
         loss = RnntLoss(blank=blank, global_batch_size=global_batch_size)
         self.use_loss_scale = use_loss_scale
+        self.allreduce_dtype = allreduce_dtype  # dtype to communicate gradients across replicas, None means variables' dtype
+        if unrolled_steps_per_execution <= 0: raise ValueError("unrolled_steps_per_execution must be positive")
+        self.unrolled_steps_per_execution = unrolled_steps_per_execution
         if self.use_loss_scale:
             optimizer = mxp.experimental.LossScaleOptimizer(tf.keras.optimizers.get(optimizer), "dynamic")
         self.loss_metric = tf.keras.metrics.Mean(name="rnnt_loss", dtype=tf.float32)
         super(Transducer, self).compile(optimizer=optimizer, loss=loss, run_eagerly=run_eagerly, **kwargs)
 
+    def make_train_function(self):
+        """ Same as keras but unroll `unrolled_steps_per_execution` steps inside the `steps_per_execution` loop
+        so XLA compiles them as one graph """
+        if self.train_function is not None or self.unrolled_steps_per_execution == 1:
+            return super(Transducer, self).make_train_function()
+
+        unroll = self.unrolled_steps_per_execution
+        strategy = self.distribute_strategy
+
+        # step_function mirrors the one of tf.keras Model.make_train_function in TensorFlow 2.4
+        def step_function(iterator):
+            def run_step(data):
+                outputs = self.train_step(data)
+                # Ensure counter is updated only if `train_step` succeeds
+                with tf.control_dependencies(tf.nest.flatten(outputs)):
+                    self._train_counter.assign_add(1)
+                return outputs
+
+            outputs = strategy.run(run_step, args=(next(iterator),))
+            # same as keras reduce_per_replica(reduction="first")
+            outputs = tf.nest.map_structure(lambda x: strategy.experimental_local_results(x)[0], outputs)
+            # same as keras write_scalar_summaries
+            for name, value in outputs.items():
+                if value.shape.ndims == 0: tf.summary.scalar("batch_" + name, value, step=self._train_counter)
+            return outputs
+
+        def train_function(iterator):
+            outputs = step_function(iterator)
+            remaining = tf.cast(self._steps_per_execution, tf.int32) - 1
+            for _ in tf.range(remaining // unroll):
+                for _ in range(unroll):  # python loop, unrolled when tracing
+                    outputs = step_function(iterator)
+            for _ in tf.range(remaining % unroll):
+                outputs = step_function(iterator)
+            return outputs
+
+        if not self.run_eagerly:
+            train_function = tf.function(train_function, experimental_relax_shapes=True)
+        self.train_function = train_function
+        return self.train_function
+
     def train_step(self, batch):
         x, y_true = batch
         with tf.GradientTape() as tape:
@@ -76,10 +131,25 @@ class Transducer(BaseTransducer):
             gradients = self.optimizer.get_unscaled_gradients(scaled_gradients)
         else:
             gradients = tape.gradient(loss, self.trainable_weights)
-        self.optimizer.apply_gradients(zip(gradients, self.trainable_variables))
+        if self.allreduce_dtype is None:
+            self.optimizer.apply_gradients(zip(gradients, self.trainable_variables))
+        else:
+            gradients = self.allreduce_gradients(gradients)
+            self.optimizer.apply_gradients(zip(gradients, self.trainable_variables),
+                                           experimental_aggregate_gradients=False)
         self.loss_metric.update_state(loss)
         return {m.name: m.result() for m in self.metrics}
 
+    def allreduce_gradients(self, gradients):
+        """ Sum gradients across replicas in `allreduce_dtype` to reduce communication, then cast them back """
+        indices = [i for i, g in enumerate(gradients) if g is not None]
+        casted = [tf.cast(tf.convert_to_tensor(gradients[i]), self.allreduce_dtype) for i in indices]
+        reduced = tf.distribute.get_replica_context().all_reduce(tf.distribute.ReduceOp.SUM, casted)
+        gradients = list(gradients)
+        for i, g in zip(indices, reduced):
+            gradients[i] = tf.cast(g, self.trainable_variables[i].dtype)
+        return gradients
+
     def test_step(self, batch):
         x, y_true = batch
         y_pred = self({
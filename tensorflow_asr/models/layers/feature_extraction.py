@@ -0,0 +1,62 @@
+# Copyright 2020 Huy Le Nguyen (@usimarit)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import tensorflow as tf
+
+from ...featurizers.speech_featurizers import TFSpeechFeaturizer, tf_normalize_signal, tf_preemphasis
+
+
+class SpeechFeatureExtraction(tf.keras.layers.Layer):
+    """ Extract features from batched raw signals inside the model, so the accelerator computes them """
+
+    def __init__(self, speech_config: dict, name: str = "speech_feature_extraction", **kwargs):
+        # stft and log are computed in float32 regardless of the mixed precision policy
+        super(SpeechFeatureExtraction, self).__init__(name=name, dtype=kwargs.pop("dtype", tf.float32), **kwargs)
+        self.speech_config = speech_config
+        self.speech_featurizer = TFSpeechFeaturizer(speech_config)
+
+    def normalize(self, features, input_length):
+        """ Mean and variance normalization of each utterance, ignoring padded frames """
+        axis = [1] if self.speech_featurizer.normalize_per_feature else [1, 2]
+        mask = tf.sequence_mask(input_length, maxlen=tf.shape(features)[1], dtype=features.dtype)
+        mask = tf.expand_dims(mask, axis=-1) * tf.ones_like(features)
+        count = tf.maximum(tf.reduce_sum(mask, axis=axis, keepdims=True), 1.0)
+        mean = tf.reduce_sum(features * mask, axis=axis, keepdims=True) / count
+        variance = tf.reduce_sum(tf.square(features - mean) * mask, axis=axis, keepdims=True) / count
+        return (features - mean) / (tf.sqrt(variance) + 1e-9) * mask
+
+    def call(self, inputs, **kwargs):
+        """
+        Args:
+            inputs: [signals with shape [B, None], number of frames of each signal with shape [B]]
+
+        Returns:
+            features: tf.Tensor with shape [B, T, F, 1]
+        """
+        signals, input_length = inputs
+        if self.speech_featurizer.normalize_signal:
+            signals = tf_normalize_signal(signals)
+        signals = tf_preemphasis(signals, self.speech_featurizer.preemphasis)
+
+        features = self.speech_featurizer.compute_features(signals)
+
+        if self.speech_featurizer.normalize_feature:
+            features = self.normalize(features, input_length)
+
+        return tf.expand_dims(features, axis=-1)
+
+    def get_config(self):
+        config = super(SpeechFeatureExtraction, self).get_config()
+        config.update({"speech_config": self.speech_config})
+        return config
@@ -171,10 +171,12 @@ class TransducerJoint(tf.keras.Model):
                 joint_dim, use_bias=False, name=f"{name}_pred",
                 kernel_regularizer=kernel_regularizer
             )
+        # output logits in float32 under mixed precision, the softmax in the loss is unstable in bfloat16/float16
         self.ffn_out = tf.keras.layers.Dense(
             vocabulary_size, name=f"{name}_vocab",
             kernel_regularizer=kernel_regularizer,
-            bias_regularizer=bias_regularizer
+            bias_regularizer=bias_regularizer,
+            dtype=tf.float32
         )
 
     def call(self, inputs, training=False, **kwargs):
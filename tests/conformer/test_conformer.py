@@ -20,6 +20,7 @@ DEFAULT_YAML = os.path.join(os.path.abspath(os.path.dirname(__file__)), "config.
 
 from tensorflow_asr.configs.config import Config
 from tensorflow_asr.models.conformer import Conformer
+from tensorflow_asr.models.keras.conformer import Conformer as KerasConformer
 from tensorflow_asr.featurizers.text_featurizers import CharFeaturizer
 from tensorflow_asr.featurizers.speech_featurizers import TFSpeechFeaturizer
 
@@ -81,5 +82,40 @@ def test_conformer():
     print(hyp)
 
 
+def test_conformer_mixed_bfloat16():
+    config = Config(DEFAULT_YAML)
+
+    text_featurizer = CharFeaturizer(config.decoder_config)
+
+    speech_featurizer = TFSpeechFeaturizer(config.speech_config)
+
+    tf.keras.mixed_precision.set_global_policy("mixed_bfloat16")
+    try:
+        model = KerasConformer(vocabulary_size=text_featurizer.num_classes, **config.model_config)
+        model._build(speech_featurizer.shape)
+        model.compile(optimizer="adam", global_batch_size=2, blank=text_featurizer.blank)
+
+        inputs = {
+            "input": tf.random.normal([2, 40] + speech_featurizer.shape[1:]),
+            "input_length": tf.constant([40, 32], dtype=tf.int32),
+            "prediction": tf.constant([[0, 1, 2, 3], [0, 4, 5, 0]], dtype=tf.int32),
+            "prediction_length": tf.constant([4, 3], dtype=tf.int32)
+        }
+        targets = {
+            "label": tf.constant([[1, 2, 3], [4, 5, 0]], dtype=tf.int32),
+            "label_length": tf.constant([3, 2], dtype=tf.int32)
+        }
+
+        assert model.encoder.compute_dtype == tf.bfloat16
+        assert model.joint_net.ffn_out.compute_dtype == tf.float32
+        assert model(inputs, training=False)["logit"].dtype == tf.float32
+
+        history = model.fit(tf.data.Dataset.from_tensors((inputs, targets)), epochs=1)
+        print(history.history)
+    finally:
+        tf.keras.mixed_precision.set_global_policy("float32")
+
+
 if __name__ == '__main__':
     test_conformer()
+    test_conformer_mixed_bfloat16()